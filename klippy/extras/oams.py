@@ -5,6 +5,7 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging
 import mcu
+import operator
 import struct
 from math import pi
 
@@ -16,21 +17,48 @@ OAMS_STATUS_COASTING = 4
 OAMS_STATUS_STOPPED = 5
 OAMS_STATUS_CALIBRATING = 6
 
+# Actions whose oams_action_status reply completes a pending command
+OAMS_ACTION_REPLIES = frozenset([OAMS_STATUS_LOADING, OAMS_STATUS_UNLOADING,
+                                 OAMS_STATUS_CALIBRATING])
+
 OAMS_OP_CODE_SUCCESS = 0
 OAMS_OP_CODE_ERROR_UNSPECIFIED = 1
 OAMS_OP_CODE_ERROR_BUSY = 2
 
+OAMS_ACTION_TIMEOUT = 120.
+OAMS_CALIBRATION_TIMEOUT = 300.
+
+FLOAT_STRUCT = struct.Struct('<f')
+U32_STRUCT = struct.Struct('<I')
+
+get_f1s_hes_values = operator.itemgetter(
+    'f1s_hes_value_0', 'f1s_hes_value_1', 'f1s_hes_value_2', 'f1s_hes_value_3')
+get_hub_hes_values = operator.itemgetter(
+    'hub_hes_value_0', 'hub_hes_value_1', 'hub_hes_value_2', 'hub_hes_value_3')
+
+# Cross section of 1.75mm filament in mm^2
+FILAMENT_AREA = pi * (1.75 / 2.)**2
+
+OAMS_STATS_FMT = ("\nOAMS: current_spool=%s fps_value=%s"
+                  " f1s_hes_value_0=%s f1s_hes_value_1=%s"
+                  " f1s_hes_value_2=%s f1s_hes_value_3=%s"
+                  " hub_hes_value_0=%s hub_hes_value_1=%s"
+                  " hub_hes_value_2=%s hub_hes_value_3=%s"
+                  " kp=%s ki=%s kd=%s\n")
+
 class OAMS:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.name = config.get_name()
         self.mcu = mcu.get_printer_mcu(self.printer, config.get("mcu", "mcu"))
+        self.gcode = self.printer.lookup_object("gcode")
+        self.configfile = self.printer.lookup_object("configfile")
         self.fps_upper_threshold = config.getfloat("fps_upper_threshold")
         self.fps_lower_threshold = config.getfloat("fps_lower_threshold")
         self.fps_is_reversed = config.getboolean("fps_is_reversed")
-        self.f1s_hes_on = list(map(lambda x: float(x.strip()), config.get("f1s_hes_on").split(",")))
+        self.f1s_hes_on = config.getfloatlist("f1s_hes_on", count=4)
         self.f1s_hes_is_above = config.getboolean("f1s_hes_is_above")
-        self.hub_hes_on = list(map(lambda x: float(x.strip()), config.get("hub_hes_on").split(",")))
+        self.hub_hes_on = config.getfloatlist("hub_hes_on", count=4)
         self.hub_hes_is_above = config.getboolean("hub_hes_is_above")
         self.filament_path_length = config.getfloat("ptfe_length")
         
@@ -41,8 +69,8 @@ class OAMS:
         self.fps_target = config.getfloat("fps_target", 0.5, minval=0.0, maxval=1.0, above=self.fps_lower_threshold, below=self.fps_upper_threshold)
         self.current_target = config.getfloat("current_target", 0.3, minval=0.1, maxval=0.4)
         
-        self.name = config.get_name()
         self.current_spool = None
+        self._status = {'current_spool': None}
         self.mcu.register_response(
             self._oams_action_status, "oams_action_status"
         )
@@ -50,39 +78,23 @@ class OAMS:
             self._oams_cmd_stats,"oams_cmd_stats"
         )
         self.mcu.register_config_callback(self._build_config)
-        self.name = config.get_name()
-        self.register_commands(self.name)
+        self.register_commands()
         self.printer.add_object("oams", self)
         self.reactor = self.printer.get_reactor()
-        self.action_status = None
-        self.action_status_code = None
+        # (expected action, completion) of the command awaiting a reply
+        self._pending_action = None
+        # Action of a timed out command whose reply has not arrived yet
+        self._stale_action = None
         self.printer.register_event_handler("klippy:ready", self.handle_ready)
         self.fps_value = 0
-        self.f1s_hes_value = [0, 0, 0, 0]
-        self.hub_hes_value = [0, 0, 0, 0]
-        super().__init__()
+        self.f1s_hes_value = (0, 0, 0, 0)
+        self.hub_hes_value = (0, 0, 0, 0)
 
-    def get_status(self, eventtime):
-        return {'current_spool': self.current_spool}
-    
     def stats(self, eventtime):
-        return (False, """
-OAMS: current_spool=%s fps_value=%s f1s_hes_value_0=%s f1s_hes_value_1=%s f1s_hes_value_2=%s f1s_hes_value_3=%s hub_hes_value_0=%s hub_hes_value_1=%s hub_hes_value_2=%s hub_hes_value_3=%s kp=%s ki=%s kd=%s
-""" 
-                % (self.current_spool,
-                   self.fps_value,
-                   self.f1s_hes_value[0],
-                   self.f1s_hes_value[1],
-                   self.f1s_hes_value[2],
-                   self.f1s_hes_value[3],
-                   self.hub_hes_value[0],
-                   self.hub_hes_value[1],
-                   self.hub_hes_value[2],
-                   self.hub_hes_value[3],
-                   self.kp,
-                   self.ki,
-                   self.kd
-                )) 
+        return (False, OAMS_STATS_FMT
+                % ((self.current_spool, self.fps_value)
+                   + self.f1s_hes_value + self.hub_hes_value
+                   + (self.kp, self.ki, self.kd)))
 
     def handle_ready(self):
         try:
@@ -118,16 +130,21 @@ OAMS: current_spool=%s fps_value=%s f1s_hes_value_0=%s f1s_hes_value_1=%s f1s_he
                 cq=cmd_queue
             )
 
-            params = self.oams_spool_query_spool_cmd.send()
-            if params is not None and 'spool' in params:
-                if params['spool'] >= 0 and params['spool'] <= 3:
-                    self.current_spool = params['spool']
+            self._sync_current_spool()
         except Exception as e:
             logging.error("Failed to initialize OAMS commands: %s", e)
+
+    def _sync_current_spool(self):
+        params = self.oams_spool_query_spool_cmd.send()
+        if params is not None and 'spool' in params:
+            if params['spool'] >= 0 and params['spool'] <= 3:
+                self._set_current_spool(params['spool'])
+            else:
+                self._set_current_spool(None)
         
-    def register_commands(self, name):
+    def register_commands(self):
         # Register commands
-        gcode = self.printer.lookup_object("gcode")
+        gcode = self.gcode
         gcode.register_command ("OAMS_LOAD_SPOOL",
             self.cmd_OAMS_LOAD_SPOOL,
             desc=self.cmd_OAMS_LOAD_SPOOL_help,
@@ -194,10 +211,10 @@ OAMS: current_spool=%s fps_value=%s f1s_hes_value_0=%s f1s_hes_value_1=%s f1s_he
 
         
         # Given a flowrate we will calculate 30 seconds of a G1 E command
-        extrusion_speed_per_min = 60*target_flow/(pi*(1.75/2)**2) # this is the G1 F parameter
-        extrusion_length = extrusion_speed_per_min/60*30 # this is the G1 E parameter
+        extrusion_speed_per_min = 60. * target_flow / FILAMENT_AREA # this is the G1 F parameter
+        extrusion_length = extrusion_speed_per_min * .5 # this is the G1 E parameter
         
-        gcode = self.printer.lookup_object("gcode")
+        gcode = self.gcode
         
         # turn on extruder heater and wait for it to stabilize
         gcode.send("M104 S%f" % target_temp)
@@ -205,20 +222,20 @@ OAMS: current_spool=%s fps_value=%s f1s_hes_value_0=%s f1s_hes_value_1=%s f1s_he
         
     cmd_OAMS_CALIBRATE_HUB_HES_help = "Calibrate the range of a single hub HES"
     def cmd_OAMS_CALIBRATE_HUB_HES(self, gcmd):
-        self.action_status = OAMS_STATUS_CALIBRATING
         spool_idx = gcmd.get_int("SPOOL", None)
         if spool_idx is None:
             raise gcmd.error("SPOOL index is required")
         if spool_idx < 0 or spool_idx > 3:
             raise gcmd.error("Invalid SPOOL index")
-        self.oams_calibrate_hub_hes_cmd.send([spool_idx])
-        while(self.action_status is not None):
-            self.reactor.pause(self.reactor.monotonic() + 0.1)
-        if self.action_status_code == OAMS_OP_CODE_SUCCESS:
-            value = self.u32_to_float(self.action_status_value)
+        params = self._run_action(self.oams_calibrate_hub_hes_cmd,
+                                  OAMS_STATUS_CALIBRATING, [spool_idx],
+                                  OAMS_CALIBRATION_TIMEOUT)
+        if params['code'] == OAMS_OP_CODE_SUCCESS:
+            value = self.u32_to_float(params['value'])
             gcmd.respond_info("Calibrated HES %d to %f threshold" % (spool_idx, value))
-            configfile = self.printer.lookup_object('configfile')
-            self.hub_hes_on[spool_idx] = value
+            configfile = self.configfile
+            self.hub_hes_on = (self.hub_hes_on[:spool_idx] + (value,)
+                               + self.hub_hes_on[spool_idx + 1:])
             values = ",".join(map(str, self.hub_hes_on))
             configfile.set(self.name, 'hub_hes_on', "%s" % (values,))
             gcmd.respond_info("Done calibrating HES, output saved to configuration")
@@ -227,39 +244,35 @@ OAMS: current_spool=%s fps_value=%s f1s_hes_value_0=%s f1s_hes_value_1=%s f1s_he
         
     cmd_OAMS_CALIBRATE_PTFE_LENGTH_help = "Calibrate the length of the PTFE tube"
     def cmd_OAMS_CALIBRATE_PTFE_LENGTH(self, gcmd):
-        self.action_status = OAMS_STATUS_CALIBRATING
         spool = gcmd.get_int("SPOOL", None)
         if spool is None:
             raise gcmd.error("SPOOL index is required")
-        self.oams_calibrate_ptfe_length_cmd.send([spool])
-        while(self.action_status is not None):
-            self.reactor.pause(self.reactor.monotonic() + 0.1)
-        if self.action_status_code == OAMS_OP_CODE_SUCCESS:
-            gcmd.respond_info("Calibrated PTFE length to %d" % self.action_status_value)
-            configfile = self.printer.lookup_object('configfile')
-            configfile.set(self.name, 'ptfe_length', "%d" % (self.action_status_value,))
+        params = self._run_action(self.oams_calibrate_ptfe_length_cmd,
+                                  OAMS_STATUS_CALIBRATING, [spool],
+                                  OAMS_CALIBRATION_TIMEOUT)
+        if params['code'] == OAMS_OP_CODE_SUCCESS:
+            gcmd.respond_info("Calibrated PTFE length to %d" % params['value'])
+            configfile = self.configfile
+            configfile.set(self.name, 'ptfe_length', "%d" % (params['value'],))
             gcmd.respond_info("Done calibrating clicks, output saved to configuration")
         else:
             gcmd.error("Calibration of PTFE length failed")
     
     cmd_OAMS_LOAD_SPOOL_help = "Load a new spool of filament"
     def cmd_OAMS_LOAD_SPOOL(self, gcmd):
-        self.action_status = OAMS_STATUS_LOADING
-        self.oams_spool_query_spool_cmd.send()
         spool_idx = gcmd.get_int("SPOOL", None)
         if spool_idx is None:
             raise gcmd.error("SPOOL index is required")
         if spool_idx < 0 or spool_idx > 3:
              raise gcmd.error("Invalid SPOOL index")
-        self.oams_load_spool_cmd.send([spool_idx])
         # we now want to wait until we get a response from the MCU
-        while(self.action_status is not None):
-            self.reactor.pause(self.reactor.monotonic() + 0.1)
+        params = self._run_action(self.oams_load_spool_cmd,
+                                  OAMS_STATUS_LOADING, [spool_idx])
         
-        if self.action_status_code == OAMS_OP_CODE_SUCCESS:
+        if params['code'] == OAMS_OP_CODE_SUCCESS:
             gcmd.respond_info("Spool loaded successfully")
-            self.current_spool = spool_idx
-        elif self.action_status_code == OAMS_OP_CODE_ERROR_BUSY:
+            self._set_current_spool(spool_idx)
+        elif params['code'] == OAMS_OP_CODE_ERROR_BUSY:
             gcmd.error("OAMS is busy")
         else:    
             gcmd.error("Unknown error from OAMS")
@@ -267,26 +280,20 @@ OAMS: current_spool=%s fps_value=%s f1s_hes_value_0=%s f1s_hes_value_1=%s f1s_he
         
     cmd_OAMS_UNLOAD_SPOOL_help = "Unload a spool of filament"
     def cmd_OAMS_UNLOAD_SPOOL(self, gcmd):
-        self.action_status = OAMS_STATUS_UNLOADING
-        self.oams_unload_spool_cmd.send()
-        while(self.action_status is not None):
-            self.reactor.pause(self.reactor.monotonic() + 0.1)
-        if self.action_status_code == OAMS_OP_CODE_SUCCESS:
+        params = self._run_action(self.oams_unload_spool_cmd,
+                                  OAMS_STATUS_UNLOADING)
+        if params['code'] == OAMS_OP_CODE_SUCCESS:
             gcmd.respond_info("Spool unloaded successfully")
-            self.current_spool = None
-        elif self.action_status_code == OAMS_OP_CODE_ERROR_BUSY:
+            self._set_current_spool(None)
+        elif params['code'] == OAMS_OP_CODE_ERROR_BUSY:
             gcmd.error("OAMS is busy")
         else:    
             gcmd.error("Unknown error from OAMS")
             
     cmd_OAMS_ENABLE_FOLLOWER_help = "Enable the follower"
     def cmd_OAMS_FOLLOWER(self, gcmd):
-        enable = gcmd.get_int("ENABLE", None)
-        if enable is None:
-            raise gcmd.error("ENABLE is required")
-        direction = gcmd.get_int("DIRECTION", None)
-        if direction is None:
-            raise gcmd.error("DIRECTION is required")
+        enable = gcmd.get_int("ENABLE", minval=0, maxval=1)
+        direction = gcmd.get_int("DIRECTION", minval=0, maxval=1)
         self.oams_follower_cmd.send([enable, direction])
         if enable == 1 and direction == 0:
             gcmd.respond_info("Follower enable in reverse direction")
@@ -297,96 +304,94 @@ OAMS: current_spool=%s fps_value=%s f1s_hes_value_0=%s f1s_hes_value_1=%s f1s_he
             
     def _oams_cmd_stats(self, params):
         self.fps_value = self.u32_to_float(params['fps_value'])
-        self.f1s_hes_value[0] = params['f1s_hes_value_0']
-        self.f1s_hes_value[1] = params['f1s_hes_value_1']
-        self.f1s_hes_value[2] = params['f1s_hes_value_2']
-        self.f1s_hes_value[3] = params['f1s_hes_value_3']
-        self.hub_hes_value[0] = params['hub_hes_value_0']
-        self.hub_hes_value[1] = params['hub_hes_value_1']
-        self.hub_hes_value[2] = params['hub_hes_value_2']
-        self.hub_hes_value[3] = params['hub_hes_value_3']
+        self.f1s_hes_value = get_f1s_hes_values(params)
+        self.hub_hes_value = get_hub_hes_values(params)
 
     def _oams_action_status(self,params):
         logging.info("oams status received")
-        if params['action'] == OAMS_STATUS_LOADING:
-            self.action_status = None
-            self.action_status_code = params['code']
-        elif params['action'] == OAMS_STATUS_UNLOADING:
-            self.action_status = None
-            self.action_status_code = params['code']
-        elif params['action'] == OAMS_STATUS_CALIBRATING:
-            self.action_status = None
-            self.action_status_code = params['code']
-            self.action_status_value = params['value']
-        else:
-            logging.error("Spurious response from AMS with code %d and action %d", params['code'], params['action'])
+        # MCU responses arrive on the serial thread, handle the reply in
+        # the reactor where the pending command state lives
+        self.reactor.register_async_callback(
+            (lambda et, p=params: self._handle_action_status(p)))
+
+    def _handle_action_status(self, params):
+        action = params['action']
+        if action not in OAMS_ACTION_REPLIES:
+            logging.error("Spurious response from AMS with code %d and action %d", params['code'], action)
+            return
+        pending = self._pending_action
+        if pending is not None and pending[0] == action:
+            pending[1].complete(params)
+            return
+        if action == self._stale_action:
+            # Reply to a command that already timed out, drop it and
+            # bring the host state back in line with the MCU
+            self._stale_action = None
+            logging.info("Dropping late OAMS action status with code %d and action %d", params['code'], action)
+            if action != OAMS_STATUS_CALIBRATING:
+                self._sync_current_spool()
+            return
+        logging.error("Unexpected OAMS action status with code %d and action %d, ignoring", params['code'], action)
+
+    def _run_action(self, cmd, action, data=(), timeout=OAMS_ACTION_TIMEOUT):
+        if self._stale_action is not None:
+            raise self.printer.command_error(
+                "OAMS is busy, waiting on the reply to a timed out command")
+        completion = self.reactor.completion()
+        self._pending_action = (action, completion)
+        try:
+            cmd.send(data)
+            params = completion.wait(self.reactor.monotonic() + timeout)
+        finally:
+            self._pending_action = None
+        if params is None:
+            # The MCU keeps running the command, its reply must not
+            # complete a later one
+            self._stale_action = action
+            raise self.printer.command_error(
+                "Timeout waiting for OAMS action status")
+        return params
 
     def float_to_u32(self, f):
-        return struct.unpack('I', struct.pack('f', f))[0]
+        return U32_STRUCT.unpack(FLOAT_STRUCT.pack(f))[0]
     
     def u32_to_float(self, i):
-        return struct.unpack('f', struct.pack('I', i))[0]
+        return FLOAT_STRUCT.unpack(U32_STRUCT.pack(i))[0]
 
 
     def _build_config(self):
+        f2u = self.float_to_u32
+        f1s_hes_on = tuple([f2u(v) for v in self.f1s_hes_on])
+        hub_hes_on = tuple([f2u(v) for v in self.hub_hes_on])
         self.mcu.add_config_cmd(
             "config_oams_buffer upper=%u lower=%u is_reversed=%u"
-            % (
-                self.float_to_u32(self.fps_upper_threshold), 
-                self.float_to_u32(self.fps_lower_threshold), 
-                self.fps_is_reversed
-            )
-        )
-
+            % (f2u(self.fps_upper_threshold), f2u(self.fps_lower_threshold),
+               self.fps_is_reversed))
         self.mcu.add_config_cmd(
             "config_oams_f1s_hes on1=%u on2=%u on3=%u on4=%u is_above=%u"
-            % ( 
-                self.float_to_u32(self.f1s_hes_on[0]),
-                self.float_to_u32(self.f1s_hes_on[1]),
-                self.float_to_u32(self.f1s_hes_on[2]),
-                self.float_to_u32(self.f1s_hes_on[3]),
-                self.f1s_hes_is_above
-            )
-        )
-
+            % (f1s_hes_on + (self.f1s_hes_is_above,)))
         self.mcu.add_config_cmd(
             "config_oams_hub_hes on1=%u on2=%u on3=%u on4=%u is_above=%u"
-            % ( 
-                self.float_to_u32(self.hub_hes_on[0]),
-                self.float_to_u32(self.hub_hes_on[1]),
-                self.float_to_u32(self.hub_hes_on[2]),
-                self.float_to_u32(self.hub_hes_on[3]),
-                self.hub_hes_is_above
-            )
-        )
-        
+            % (hub_hes_on + (self.hub_hes_is_above,)))
         self.mcu.add_config_cmd(
             "config_oams_pid kp=%u ki=%u kd=%u target=%u"
-            % (
-                self.float_to_u32(self.kp), 
-                self.float_to_u32(self.ki), 
-                self.float_to_u32(self.kd),
-                self.float_to_u32(self.fps_target)
-            )
-        )
-
+            % (f2u(self.kp), f2u(self.ki), f2u(self.kd),
+               f2u(self.fps_target)))
+        # ptfe_length is a click count, the MCU expects an integer
         self.mcu.add_config_cmd(
-            "config_oams_ptfe length=%u"
-            % (self.filament_path_length)
-        )
-        
+            "config_oams_ptfe length=%u" % (int(self.filament_path_length),))
         self.mcu.add_config_cmd(
-            "config_oams_current target=%u"
-            % (
-                self.float_to_u32(self.current_target)
-            )
-        )
+            "config_oams_current target=%u" % (f2u(self.current_target),))
         
+    def _set_current_spool(self, spool):
+        self.current_spool = spool
+        # Replace the dict rather than update it, webhooks diffs status
+        # against the previously returned object
+        self._status = {'current_spool': spool}
+
     # these are available to the gcode
     def get_status(self, eventtime):
-        return {
-            'current_spool': self.current_spool
-        }
+        return self._status
 
 
 def load_config_prefix(config):
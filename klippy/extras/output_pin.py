@@ -21,9 +21,11 @@ class PrinterOutputPin:
             hardware_pwm = config.getboolean('hardware_pwm', False)
             self.mcu_pin.setup_cycle_time(cycle_time, hardware_pwm)
             self.scale = config.getfloat('scale', 1., above=0.)
+            self.set_mcu_value = self.mcu_pin.set_pwm
         else:
             self.mcu_pin = ppins.setup_pin('digital_out', config.get('pin'))
             self.scale = 1.
+            self.set_mcu_value = self.mcu_pin.set_digital
         self.last_print_time = 0.
         # Support mcu checking for maximum duration
         self.reactor = self.printer.get_reactor()
@@ -60,10 +62,7 @@ class PrinterOutputPin:
         if value == self.last_value and not is_resend:
             return
         print_time = max(print_time, self.last_print_time + PIN_MIN_TIME)
-        if self.is_pwm:
-            self.mcu_pin.set_pwm(print_time, value)
-        else:
-            self.mcu_pin.set_digital(print_time, value)
+        self.set_mcu_value(print_time, value)
         self.last_value = value
         self.last_print_time = print_time
         if self.resend_interval and self.resend_timer is None: